@@ -1,70 +1,157 @@
 # api/poll.py
-import os, json, hashlib
+import os, asyncio, logging
 from typing import Dict, Any, Set, List
 from fastapi import FastAPI
-from upstash_redis import Redis
+from upstash_redis.asyncio import Redis
 import httpx
-from html import escape as H
+import xxhash
+import orjson
 
 API_URL = "https://gagstock.gleeze.com/grow-a-garden"
 BOT_TOKEN = os.environ["TELEGRAM_BOT_TOKEN"]
 TG = f"https://api.telegram.org/bot{BOT_TOKEN}"
 
+SEND_CONCURRENCY = 30  # max sends in flight at once (caps concurrency, not msg/sec)
+
+log = logging.getLogger("gagstock-poll")
 app = FastAPI()
 redis = Redis(url=os.environ["kv_KV_REST_API_URL"], token=os.environ["kv_KV_REST_API_TOKEN"])
 
-def b(x): return f"<b>{H(x)}</b>"
-def code(x): return f"<code>{H(x)}</code>"
-def li(x): return f"• {H(x)}"
+# shared client: keeps TLS connections warm across polls on a warm instance;
+# HTTP/2 lets concurrent sends multiplex over a single connection
+# (limits/http2 live on the transport; httpx ignores them on the client when one is given)
+CLIENT = httpx.AsyncClient(
+    base_url=TG, timeout=20,
+    transport=httpx.AsyncHTTPTransport(
+        http2=True, retries=1,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=75),
+    ),
+)
+
+@app.on_event("shutdown")
+async def _close_client():
+    await CLIENT.aclose()
+
+# Telegram HTML only needs &, < and > escaped; translate() does it in one pass
+_TR = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+def _esc(s): return s.translate(_TR)
+
+def b(x): return f"<b>{_esc(x)}</b>"
+def code(x): return f"<code>{_esc(x)}</code>"
+def li(x): return f"• {_esc(x)}"
 
 def hash_payload(data: Dict[str, Any]) -> str:
-    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    # change detection only, no need for a cryptographic hash
+    return xxhash.xxh3_64_hexdigest(orjson.dumps(data, option=orjson.OPT_SORT_KEYS))
+
+_ORDER = ("egg","gear","seed","honey","cosmetics","travelingmerchant")
+_ORDER_SET = frozenset(_ORDER)
+
+# headers for the known categories, escaped once at import
+CAT_HEADERS = {k: b(k.capitalize()) for k in _ORDER}
 
 def fmt_cat(name: str, payload: Dict[str, Any]) -> str:
+    esc = _esc
     items = (payload or {}).get("items", [])
     cd = (payload or {}).get("countdown")
-    parts = [b(name.capitalize())]
-    if cd: parts.append(f"Refresh in: {code(str(cd))}")
+    parts = [CAT_HEADERS.get(name) or b(name.capitalize())]
+    if cd: parts.append(f"Refresh in: <code>{esc(str(cd))}</code>")
     if items:
         for it in items:
             nm = it.get("name", "?"); qty = it.get("quantity", "?"); emoji = it.get("emoji","")
-            parts.append(li(f"{emoji} {nm} ×{qty}"))
+            parts.append(f"• {esc(f'{emoji} {nm} ×{qty}')}")
     else:
         parts.append("<i>No items</i>")
     return "\n".join(parts)
 
 def fmt_msg(payload: Dict[str, Any], updated_at: str) -> str:
     data = payload.get("data") or {}
-    order = ["egg","gear","seed","honey","cosmetics","travelingmerchant"]
-    sections = [fmt_cat(k, data[k]) for k in order if k in data] + \
-               [fmt_cat(k, v) for k,v in data.items() if k not in order]
+    sections = [fmt_cat(k, data[k]) for k in _ORDER if k in data] + \
+               [fmt_cat(k, v) for k,v in data.items() if k not in _ORDER_SET]
     return f"{b('GAG Stock Update')}\nupdated_at: {code(updated_at)}" + ("\n\n" + "\n\n".join(sections) if sections else "")
 
+# subscriber list cached per warm instance; refetched only when api/telegram.py bumps subs_version
+_SUBS_CACHE: List[int] = []
+_SUBS_VER: Any = object()
+
+async def get_subs(version) -> List[int]:
+    global _SUBS_CACHE, _SUBS_VER
+    if version != _SUBS_VER:
+        _SUBS_CACHE = list(await redis.get("subs") or [])
+        _SUBS_VER = version
+    return _SUBS_CACHE
+
+SEND_SEM = asyncio.Semaphore(SEND_CONCURRENCY)
+
+JSON_HEADERS = {"content-type": "application/json"}
+
+async def _send(cid: int, body_tail: bytes):
+    async with SEND_SEM:
+        body = b'{"chat_id":' + str(cid).encode() + b"," + body_tail
+        r = await CLIENT.post("/sendMessage", content=body, headers=JSON_HEADERS)
+        r.raise_for_status()  # surface 429/403 etc. to send_all's logging
+
 async def send_all(chat_ids: List[int], text: str):
-    async with httpx.AsyncClient(timeout=20) as c:
-        for cid in chat_ids:
-            await c.post(f"{TG}/sendMessage", json={"chat_id": cid, "text": text, "parse_mode": "HTML"})
+    # text/parse_mode are the same for everyone: encode them once, splice in chat_id per send
+    body_tail = orjson.dumps({"text": text, "parse_mode": "HTML"})[1:]  # drop leading '{'
+    results = await asyncio.gather(*[_send(cid, body_tail) for cid in chat_ids], return_exceptions=True)
+    for r in results:
+        if isinstance(r, Exception):
+            log.warning("Send failed: %s", r)
 
 @app.get("/")
 async def run():
     # fetch
-    async with httpx.AsyncClient(timeout=15) as c:
-        r = await c.get(API_URL, headers={"Accept":"application/json"})
-        data = r.json()
-        if isinstance(data, str):
-            data = json.loads(data)
+    state, subs_ver = await redis.mget("state", "subs_version")
+    state = state or {"updated_at": None, "hash": None}
+    headers = {"Accept":"application/json"}
+    if state.get("etag"): headers["If-None-Match"] = state["etag"]
+    if state.get("last_modified"): headers["If-Modified-Since"] = state["last_modified"]
+
+    r = await CLIENT.get(API_URL, headers=headers, timeout=15)
+    if r.status_code == 304:
+        return {"ok": True, "changed": False, "updated_at": state.get("updated_at")}
+    data = orjson.loads(r.content)
+    if isinstance(data, str):
+        data = orjson.loads(data)
 
-    updated_at = data.get("updated_at") or "unknown"
+    ts = data.get("updated_at")
+    updated_at = ts or "unknown"
     inner = data.get("data") or {}
-    h = hash_payload(inner)
+    etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
 
-    state = redis.get("state") or {"updated_at": None, "hash": None}
-    changed = (state.get("updated_at") != updated_at) or (state.get("hash") != h) or (state.get("updated_at") is None)
+    # a new updated_at is authoritative; only hash when it is missing or unchanged
+    h = None
+    if ts and ts != state.get("updated_at"):
+        changed = True
+    else:
+        h = hash_payload(inner)
+        # same updated_at and no stored hash yet: nothing to compare against, just backfill it
+        changed = state.get("hash") != h and (not ts or state.get("hash") is not None)
 
     if changed:
+        # atomic claim so concurrent invocations don't broadcast the same payload twice;
+        # overlapped with the subscriber refresh
+        key = f"msg:{h}:{updated_at}"
+        # msg_key is stored verbatim: h may be None here and backfilled later, so /now can't rebuild it
+        new_state = {"updated_at": updated_at, "hash": h, "msg_key": key, "etag": etag, "last_modified": last_modified}
+        claimed, subs = await asyncio.gather(
+            redis.set(f"state:{updated_at}:{h}", "1", nx=True, ex=86400),
+            get_subs(subs_ver),
+        )
+        if not claimed:
+            # still record what we saw, so a winner that died before its write can't wedge the state
+            await redis.set("state", new_state)
+            return {"ok": True, "changed": False, "updated_at": updated_at}
+        # only the claim winner renders this payload, so the cache is write-only here (read by /now)
         msg = fmt_msg(data, updated_at)
-        subs = redis.get("subs") or []
-        await send_all(list(subs), msg)
-        redis.set("state", {"updated_at": updated_at, "hash": h})
+        await send_all(subs, msg)
+        pipe = redis.pipeline()
+        pipe.set(key, msg, ex=3600)
+        pipe.set("state", new_state)
+        await pipe.exec()
+    elif (h, etag, last_modified) != (state.get("hash"), state.get("etag"), state.get("last_modified")):
+        # backfill the hash skipped on the timestamp path, or refresh validators
+        await redis.set("state", {**state, "hash": h, "etag": etag, "last_modified": last_modified})
 
     return {"ok": True, "changed": bool(changed), "updated_at": updated_at}
@@ -2,7 +2,7 @@
 import os, json, textwrap
 from typing import Set, Dict, Any
 from fastapi import FastAPI, Request
-from upstash_redis import Redis
+from upstash_redis.asyncio import Redis
 import httpx
 
 app = FastAPI()
@@ -11,24 +11,37 @@ TG = f"https://api.telegram.org/bot{BOT_TOKEN}"
 redis = Redis(url=os.environ["kv_KV_REST_API_URL"], token=os.environ["kv_KV_REST_API_TOKEN"])
 
 # ---- persistence helpers (Redis) ----
-def get_subscribers() -> Set[int]:
-    raw = redis.get("subs")
+async def get_subscribers() -> Set[int]:
+    raw = await redis.get("subs")
     return set(raw) if isinstance(raw, list) else set()
 
-def save_subscribers(s: Set[int]):
-    redis.set("subs", list(s))
+async def save_subscribers(s: Set[int]):
+    # bump the version so the poller knows to refresh its cached copy
+    pipe = redis.pipeline()
+    pipe.set("subs", list(s))
+    pipe.incr("subs_version")
+    await pipe.exec()
 
-def get_state() -> Dict[str, Any]:
-    return redis.get("state") or {"updated_at": None, "hash": None}
+async def get_state() -> Dict[str, Any]:
+    return await redis.get("state") or {"updated_at": None, "hash": None}
 
-def save_state(st: Dict[str, Any]):
-    redis.set("state", st)
+async def save_state(st: Dict[str, Any]):
+    await redis.set("state", st)
 
 async def send_message(chat_id: int, text: str):
     async with httpx.AsyncClient(timeout=15) as c:
         await c.post(f"{TG}/sendMessage", json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"})
 
 # ---- commands ----
+START_MSG = textwrap.dedent("""\
+    Hi! I’ll notify you when GAG Stock updates.
+    Commands:
+    /subscribe – receive updates
+    /unsubscribe – stop updates
+    /status – show latest known timestamp
+    /now – fetch and push the current stock immediately
+""")
+
 @app.post("/")
 async def webhook(request: Request):
     u = await request.json()
@@ -39,27 +52,25 @@ async def webhook(request: Request):
     if not cid or not text.startswith("/"):
         return {"ok": True}
 
-    subs = get_subscribers()
+    subs = await get_subscribers()
 
     if text.startswith("/start"):
-        await send_message(cid, textwrap.dedent("""\
-            Hi! I’ll notify you when GAG Stock updates.
-            Commands:
-            /subscribe – receive updates
-            /unsubscribe – stop updates
-            /status – show latest known timestamp
-            /now – fetch and push the current stock immediately
-        """))
+        await send_message(cid, START_MSG)
     elif text.startswith("/subscribe"):
-        subs.add(cid); save_subscribers(subs)
+        subs.add(cid); await save_subscribers(subs)
         await send_message(cid, "Subscribed! Use /now to get the latest instantly.")
     elif text.startswith("/unsubscribe"):
-        subs.discard(cid); save_subscribers(subs)
+        subs.discard(cid); await save_subscribers(subs)
         await send_message(cid, "Unsubscribed.")
     elif text.startswith("/status"):
-        st = get_state()
+        st = await get_state()
         await send_message(cid, f"Last known updated_at: {st.get('updated_at') or 'unknown'}")
     elif text.startswith("/now"):
+        # Reply straight away with the last rendered stock, if still cached
+        st = await get_state()
+        cached = await redis.get(st["msg_key"]) if st.get("msg_key") else None
+        if cached:
+            await send_message(cid, cached)
         # Kick the poller manually
         async with httpx.AsyncClient(timeout=15) as c:
             await c.get("https://" + os.environ["VERCEL_URL"] + "/api/poll")
@@ -1,14 +1,19 @@
 import os
 import json
 import asyncio
-import hashlib
 import logging
+import time
 import textwrap
-from typing import Dict, Any, Set
+from datetime import datetime
+from email.utils import format_datetime
+from typing import Dict, Any, Set, Optional, Tuple
 
+import aiofiles
+import aiofiles.os
 import aiohttp
+import orjson
+import xxhash
 from aiohttp import ClientTimeout
-from html import escape as html_escape
 
 from telegram import Update
 from telegram.constants import ParseMode
@@ -17,9 +22,16 @@ from telegram.ext import Application, CommandHandler, ContextTypes
 
 # === Config ===
 API_URL = "https://gagstock.gleeze.com/grow-a-garden"
-POLL_SECONDS = 60  # be nice to the API
+POLL_SECONDS = 60  # be nice to the API; also the fallback when the refresh cadence is unknown
+MIN_POLL_SECONDS = 15  # adaptive poll delay is clamped to [MIN, MAX]
+MAX_POLL_SECONDS = 70  # kept under KEEPALIVE_SECONDS so long sleeps still reuse the connection
+REFRESH_EWMA_ALPHA = 0.3  # weight of the newest observed refresh interval
+REFRESH_OUTLIER_FACTOR = 3  # refresh gaps longer than this × interval are ignored (downtime, missed polls)
+KEEPALIVE_SECONDS = 75  # > MAX_POLL_SECONDS so each poll reuses the last connection (nginx default)
+SEND_CONCURRENCY = 30  # max sends in flight at once (caps concurrency, not msg/sec)
 SUBS_FILE = "subscribers.json"
 STATE_FILE = "last_state.json"
+FLUSH_SECONDS = 5  # how often pending subscriber changes are written to disk
 
 logging.basicConfig(
     level=logging.INFO,
@@ -45,8 +57,35 @@ def save_json(path: str, data):
 def load_subscribers() -> Set[int]:
     return set(load_json(SUBS_FILE, []))
 
-def save_subscribers(subs: Set[int]):
-    save_json(SUBS_FILE, list(subs))
+# Subscriber writes are coalesced: handlers only mark the set dirty and
+# subscriber_flusher() writes it out in the background.
+_subs_dirty = False
+
+def save_subscribers():
+    global _subs_dirty
+    _subs_dirty = True
+
+async def flush_subscribers():
+    global _subs_dirty
+    if not _subs_dirty:
+        return
+    _subs_dirty = False
+    tmp = SUBS_FILE + ".tmp"
+    try:
+        async with aiofiles.open(tmp, "w", encoding="utf-8") as f:
+            await f.write(json.dumps(list(SUBSCRIBERS), ensure_ascii=False, indent=2))
+        await aiofiles.os.replace(tmp, SUBS_FILE)
+    except Exception:
+        _subs_dirty = True  # retry on the next flush
+        raise
+
+async def subscriber_flusher():
+    while True:
+        await asyncio.sleep(FLUSH_SECONDS)
+        try:
+            await flush_subscribers()
+        except Exception as e:
+            log.error("Subscriber flush failed: %s", e)
 
 def load_last_state() -> Dict[str, Any]:
     return load_json(STATE_FILE, {"updated_at": None, "hash": None})
@@ -57,22 +96,59 @@ def save_last_state(state: Dict[str, Any]):
 
 # === Utility ===
 def hash_payload(data: Dict[str, Any]) -> str:
-    return hashlib.sha256(
-        json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
-    ).hexdigest()
+    # Change detection only, so a fast non-cryptographic hash is enough
+    return xxhash.xxh3_64_hexdigest(orjson.dumps(data, option=orjson.OPT_SORT_KEYS))
+
+def parse_updated_at(updated_at: Optional[str]) -> Optional[datetime]:
+    """Parse the API's ISO `updated_at` into an aware datetime, or None if unparseable."""
+    if not updated_at:
+        return None
+    try:
+        dt = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else None
+
+def http_date(updated_at: Optional[str]) -> Optional[str]:
+    """Convert the API's ISO `updated_at` into an HTTP date, or None if unparseable."""
+    dt = parse_updated_at(updated_at)
+    return format_datetime(dt.replace(microsecond=0), usegmt=True) if dt else None
+
+def poll_delay(updated_at: Optional[str], interval: Optional[float]) -> float:
+    """
+    Seconds to sleep before the next poll: aim just after the next expected
+    refresh (last `updated_at` + observed interval), clamped to the poll bounds.
+    Once the refresh is more than one interval overdue, fall back to POLL_SECONDS.
+    """
+    last = parse_updated_at(updated_at)
+    if last is None or interval is None:
+        return POLL_SECONDS
+    remaining = last.timestamp() + interval + 2 - time.time()
+    if remaining < -interval:
+        return POLL_SECONDS
+    return min(MAX_POLL_SECONDS, max(MIN_POLL_SECONDS, remaining))
+
+# HTML-safe helpers (avoid Telegram Markdown entity issues).
+# Telegram HTML only needs &, < and > escaped; translate() does it in one pass.
+_TR = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+def _esc(s: str) -> str:
+    return s.translate(_TR)
 
-# HTML-safe helpers (avoid Telegram Markdown entity issues)
 def b(x: str) -> str:
-    return f"<b>{html_escape(x)}</b>"
+    return f"<b>{_esc(x)}</b>"
 
 def code(x: str) -> str:
-    return f"<code>{html_escape(x)}</code>"
+    return f"<code>{_esc(x)}</code>"
 
 def li(x: str) -> str:
-    return f"• {html_escape(x)}"
+    return f"• {_esc(x)}"
 
 
 # === Message formatting based on documented response shape ===
+PREFERRED_ORDER = ("egg", "gear", "seed", "honey", "cosmetics", "travelingmerchant")
+_PREFERRED_SET = frozenset(PREFERRED_ORDER)
+
 def format_category(name: str, payload: Dict[str, Any]) -> str:
     items = payload.get("items", []) if isinstance(payload, dict) else []
     cd = payload.get("countdown") if isinstance(payload, dict) else None
@@ -84,7 +160,7 @@ def format_category(name: str, payload: Dict[str, Any]) -> str:
         appear = payload.get("appearIn") if isinstance(payload, dict) else None
         merchant = payload.get("merchantName") if isinstance(payload, dict) else None
         parts = [header]
-        if merchant: parts.append(f"Merchant: <i>{html_escape(str(merchant))}</i>")
+        if merchant: parts.append(f"Merchant: <i>{_esc(str(merchant))}</i>")
         if status: parts.append(f"Status: {code(str(status))}")
         if appear: parts.append(f"Appears in: {code(str(appear))}")
         if items and isinstance(items, list):
@@ -119,12 +195,11 @@ def format_message(payload: Dict[str, Any], updated_at: str) -> str:
         data = {}
 
     sections = []
-    preferred_order = ["egg", "gear", "seed", "honey", "cosmetics", "travelingmerchant"]
-    for key in preferred_order:
+    for key in PREFERRED_ORDER:
         if key in data:
             sections.append(format_category(key, data.get(key, {})))
     for key in data:
-        if key not in preferred_order:
+        if key not in _PREFERRED_SET:
             sections.append(format_category(key, data.get(key, {})))
 
     header = f"{b('GAG Stock Update')}\nupdated_at: {code(updated_at)}"
@@ -132,31 +207,47 @@ def format_message(payload: Dict[str, Any], updated_at: str) -> str:
 
 
 # === Network ===
-async def fetch_api(session: aiohttp.ClientSession) -> Dict[str, Any]:
+async def fetch_api(
+    session: aiohttp.ClientSession, state: Optional[Dict[str, Any]] = None
+) -> Tuple[Optional[Dict[str, Any]], Dict[str, Optional[str]]]:
     """
     Robustly fetch and parse the API, handling cases where the server returns:
       - a JSON object (expected)
       - a JSON string (sometimes containing JSON again)
       - non-JSON / HTML or other errors
+
+    If `state` is given, the request is made conditional on its stored
+    ETag / Last-Modified (falling back to `updated_at`), and the payload is
+    None when the server answers 304. Returns (payload, validators), where
+    validators holds the response's `etag` and `last_modified` for next time.
     """
     headers = {
         "Accept": "application/json",
         "User-Agent": "gagstock-telegram-bot/1.0"
     }
+    if state:
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        ims = state.get("last_modified") or http_date(state.get("updated_at"))
+        if ims:
+            headers["If-Modified-Since"] = ims
     async with session.get(API_URL, headers=headers, timeout=ClientTimeout(total=15)) as resp:
-        text = await resp.text()
+        validators = {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+        if resp.status == 304:
+            return None, validators
+        body = await resp.read()
         # First parse attempt
         try:
-            data = json.loads(text)
-        except json.JSONDecodeError:
-            raise RuntimeError(f"Non-JSON response ({resp.status} {resp.content_type}): {text[:200]!r}")
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            raise RuntimeError(f"Non-JSON response ({resp.status} {resp.content_type}): {body[:200]!r}")
 
         # If it's a JSON string, try to parse the inner content
         if isinstance(data, str):
             try:
-                maybe = json.loads(data)
+                maybe = orjson.loads(data)
                 if isinstance(maybe, dict):
-                    return maybe
+                    return maybe, validators
             except Exception:
                 pass
             raise RuntimeError(f"Unexpected JSON string: {data[:200]!r}")
@@ -164,17 +255,20 @@ async def fetch_api(session: aiohttp.ClientSession) -> Dict[str, Any]:
         if not isinstance(data, dict):
             raise RuntimeError(f"Unexpected JSON type: {type(data)}; head: {str(data)[:200]!r}")
 
-        return data
+        return data, validators
 
 
 # === Broadcast ===
+SEND_SEM = asyncio.Semaphore(SEND_CONCURRENCY)
+
+async def send_one(application: Application, cid: int, text: str):
+    async with SEND_SEM:
+        await application.bot.send_message(chat_id=cid, text=text, parse_mode=ParseMode.HTML)
+
 async def broadcast(application: Application, text: str):
     if not SUBSCRIBERS:
         return
-    tasks = [
-        application.bot.send_message(chat_id=cid, text=text, parse_mode=ParseMode.HTML)
-        for cid in SUBSCRIBERS
-    ]
+    tasks = [send_one(application, cid, text) for cid in SUBSCRIBERS]
     results = await asyncio.gather(*tasks, return_exceptions=True)
     for r in results:
         if isinstance(r, Exception):
@@ -184,73 +278,97 @@ async def broadcast(application: Application, text: str):
 # === Watcher loop ===
 async def watcher(application: Application):
     state = load_last_state()
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                payload = await fetch_api(session)
-
-                if not isinstance(payload, dict) or "data" not in payload:
-                    log.error("Bad payload shape: %s", str(payload)[:200])
-                    await asyncio.sleep(POLL_SECONDS)
-                    continue
-
-                updated_at = payload.get("updated_at")
-                data = payload.get("data") or {}
-                if not isinstance(data, dict):
-                    log.error("Bad data field: %s", str(data)[:200])
-                    await asyncio.sleep(POLL_SECONDS)
-                    continue
-
+    session: aiohttp.ClientSession = application.bot_data["session"]
+    interval: Optional[float] = None  # EWMA of seconds between upstream refreshes
+    # Last updated_at seen by this process; the persisted one may predate downtime,
+    # so it is never used as an interval sample
+    last_seen: Optional[datetime] = None
+    while True:
+        try:
+            payload, validators = await fetch_api(session, state)
+            if payload is None:
+                # 304: nothing changed upstream since the last poll
+                await asyncio.sleep(poll_delay(state.get("updated_at"), interval))
+                continue
+
+            if not isinstance(payload, dict) or "data" not in payload:
+                log.error("Bad payload shape: %s", str(payload)[:200])
+                await asyncio.sleep(POLL_SECONDS)
+                continue
+
+            updated_at = payload.get("updated_at")
+            data = payload.get("data") or {}
+            if not isinstance(data, dict):
+                log.error("Bad data field: %s", str(data)[:200])
+                await asyncio.sleep(POLL_SECONDS)
+                continue
+
+            # A new timestamp is authoritative; only hash when it's missing or unchanged
+            payload_hash = None
+            changed = False
+            reason = ""
+            if updated_at and updated_at != state.get("updated_at"):
+                changed = True; reason = "timestamp"
+                cur = parse_updated_at(updated_at)
+                if last_seen and cur and cur > last_seen:
+                    delta = (cur - last_seen).total_seconds()
+                    if interval is None:
+                        interval = delta
+                    elif delta <= REFRESH_OUTLIER_FACTOR * interval:
+                        interval = REFRESH_EWMA_ALPHA * delta + (1 - REFRESH_EWMA_ALPHA) * interval
+                last_seen = cur or last_seen
+            else:
                 payload_hash = hash_payload(data)
-
-                changed = False
-                reason = ""
-                if updated_at and updated_at != state.get("updated_at"):
-                    changed = True; reason = "timestamp"
-                elif payload_hash != state.get("hash"):
+                # Same timestamp with no stored hash: just backfill it
+                if payload_hash != state.get("hash") and (not updated_at or state.get("hash")):
                     changed = True; reason = "content-hash"
 
-                # Initial boot: push once if we have a timestamp
-                if state.get("updated_at") is None and updated_at:
-                    changed = True; reason = "initial"
-
-                if changed:
-                    msg = format_message(payload, updated_at or "unknown")
-                    await broadcast(application, msg)
-                    log.info("Broadcasted update to %d subscriber(s) (%s)", len(SUBSCRIBERS), reason)
+            # Initial boot: push once if we have a timestamp
+            if state.get("updated_at") is None and updated_at:
+                changed = True; reason = "initial"
 
-                state = {"updated_at": updated_at, "hash": payload_hash}
-                save_last_state(state)
+            if changed:
+                msg = format_message(payload, updated_at or "unknown")
+                await broadcast(application, msg)
+                log.info("Broadcasted update to %d subscriber(s) (%s)", len(SUBSCRIBERS), reason)
 
-            except Exception as e:
-                log.error("Watcher error: %s", e)
+            state = {"updated_at": updated_at, "hash": payload_hash, **validators}
+            save_last_state(state)
 
+        except Exception as e:
+            log.error("Watcher error: %s", e)
+            # Fixed backoff on errors; only successful polls use the adaptive delay
             await asyncio.sleep(POLL_SECONDS)
+            continue
+
+        await asyncio.sleep(poll_delay(state.get("updated_at"), interval))
 
 
 # === Telegram handlers ===
 SUBSCRIBERS: Set[int] = load_subscribers()
 
+START_MSG = textwrap.dedent("""\
+    Hi! I’ll notify you when GAG Stock updates.
+    Commands:
+    /subscribe – receive updates
+    /unsubscribe – stop updates
+    /status – show latest known timestamp
+    /now – fetch and push the current stock immediately
+""")
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(textwrap.dedent("""\
-        Hi! I’ll notify you when GAG Stock updates.
-        Commands:
-        /subscribe – receive updates
-        /unsubscribe – stop updates
-        /status – show latest known timestamp
-        /now – fetch and push the current stock immediately
-    """))
+    await update.message.reply_text(START_MSG)
 
 async def cmd_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     SUBSCRIBERS.add(cid)
-    save_subscribers(SUBSCRIBERS)
+    save_subscribers()
     await update.message.reply_text("Subscribed! You’ll get messages on updates. Use /now to get the latest instantly.")
 
 async def cmd_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cid = update.effective_chat.id
     SUBSCRIBERS.discard(cid)
-    save_subscribers(SUBSCRIBERS)
+    save_subscribers()
     await update.message.reply_text("Unsubscribed. You won’t receive further updates.")
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -259,8 +377,8 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        async with aiohttp.ClientSession() as session:
-            payload = await fetch_api(session)
+        session = context.application.bot_data["session"]
+        payload, _ = await fetch_api(session)
         msg = format_message(payload, payload.get("updated_at") or "unknown")
         await broadcast(context.application, msg)
         await update.message.reply_text("Pushed the latest stock to all subscribers.")
@@ -268,7 +386,18 @@ async def cmd_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"Fetch failed: {e}")
 
 async def on_start(application: Application):
+    # One session shared by the watcher and /now, so connections stay warm
+    application.bot_data["session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=50, keepalive_timeout=KEEPALIVE_SECONDS, ttl_dns_cache=300)
+    )
     application.create_task(watcher(application))
+    application.create_task(subscriber_flusher())
+
+async def on_stop(application: Application):
+    await flush_subscribers()
+    session = application.bot_data.pop("session", None)
+    if session:
+        await session.close()
 
 
 # === Main ===
@@ -277,6 +406,13 @@ def main():
     if not token:
         raise SystemExit("Set TELEGRAM_BOT_TOKEN env var")
 
+    # Faster event loop where available (not on Windows)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
     app = Application.builder().token(token).build()
 
     app.add_handler(CommandHandler("start", cmd_start))
@@ -287,6 +423,7 @@ def main():
 
     # Launch watcher when the bot starts
     app.post_init = on_start
+    app.post_shutdown = on_stop
 
     log.info("Starting bot…")
     app.run_polling()